@@ -1,10 +1,14 @@
-from flask import Flask, request, render_template, flash
+from flask import Flask, request, render_template, flash, url_for, jsonify, send_from_directory
 import os
 import logging
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from stt.rev import transcribe_to_files
-from translate.translate import translate_srt
-from tts.eleven_labs import generate_speech
+from stt.rev import submit_transcription, get_transcript, get_job_status, wait_for_job, write_transcript_files
+from translate.translate import translate_srt_text
+from tts.eleven_labs import generate_speech_from_text
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,89 +22,250 @@ rev_ai_lang_map = {
     'zh': 'cmn'   # Mandarin Chinese
 }
 
+# Translated audio, transcripts and translations are written here; created once at startup
+RESULTS_DIR = "results"
+os.makedirs(RESULTS_DIR, exist_ok=True)
+
+# Uploads are copied to disk in 1 MB chunks
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Rev.ai jobs and their progress, keyed by job id, so the callback knows what to do next
+JOBS_DB = "jobs.db"
+
+# Public URL Rev.ai can reach this app at (e.g. https://pods.example.com); without it jobs are polled instead of
+# waiting for a callback, since app.run only listens on 127.0.0.1
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL")
+
+# Translation + TTS run here once Rev.ai calls back, off the request threads
+pipeline_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_WORKERS", "2")))
+
+# Jobs submitted without a callback URL are polled here until Rev.ai finishes them
+poll_executor = ThreadPoolExecutor(thread_name_prefix="rev_poll")
+
+
+def get_jobs_db():
+    """Open the jobs database, creating the table if needed."""
+    conn = sqlite3.connect(JOBS_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "job_id TEXT PRIMARY KEY, from_lang TEXT, to_lang TEXT, original_filename TEXT, "
+        "status TEXT, output_filename TEXT)"
+    )
+    return conn
+
+
+def save_job(job_id, from_lang, to_lang, original_filename):
+    """Remember a submitted Rev.ai job until its callback arrives."""
+    with get_jobs_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, 'transcribing', NULL)",
+            (job_id, from_lang, to_lang, original_filename)
+        )
+
+
+def get_job(job_id):
+    """Look up a job. Returns None if it is unknown."""
+    with get_jobs_db() as conn:
+        return conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def set_job_status(job_id, status, output_filename=None, expected_status=None):
+    """
+    Update a job's status.
+
+    Args:
+        job_id (str): The Rev.ai job ID
+        status (str): New status - transcribing, translating, done or failed
+        output_filename (str): Name of the translated mp3 in results/, once it exists
+        expected_status (str): Only update if the job currently has this status
+
+    Returns:
+        bool: Whether the job was updated
+    """
+    query = "UPDATE jobs SET status = ?, output_filename = ? WHERE job_id = ?"
+    params = [status, output_filename, job_id]
+    if expected_status is not None:
+        query += " AND status = ?"
+        params.append(expected_status)
+    with get_jobs_db() as conn:
+        return conn.execute(query, params).rowcount == 1
+
+
+def run_pipeline(job_id, from_lang, to_lang, original_filename):
+    """Translate a finished Rev.ai transcript and synthesize the translated audio."""
+    try:
+        # Fetch the finished transcript from Rev.ai
+        logger.info(f"Retrieving transcript for job {job_id}")
+        captions, formatted_transcript = get_transcript(job_id, fix_transcript=True)
+
+        # Create timestamp and base name shared by every output file
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        original_name = os.path.splitext(os.path.basename(original_filename))[0]
+
+        # Keep the transcript as soon as it exists, so it survives a later failure
+        write_transcript_files(captions, formatted_transcript, RESULTS_DIR, original_name, timestamp, "both")
+
+        # Translate srt using OpenAI
+        logger.info("Starting translation")
+        translated_srt = translate_srt_text(captions, from_lang, to_lang)
+        translated_srt_path = os.path.join(RESULTS_DIR, f"{original_name}_{timestamp}_{from_lang}_to_{to_lang}.srt")
+        with open(translated_srt_path, 'w', encoding='utf-8') as f:
+            f.write(translated_srt)
+
+        # Generate audio from translated text using ElevenLabs
+        logger.info("Converting translation to speech using ElevenLabs")
+        output_filename = f"{original_name}_{timestamp}_translated.mp3"
+        output_path = os.path.join(RESULTS_DIR, output_filename)
+
+        # Generate speech using ElevenLabs with multiple default voices
+        generate_speech_from_text(
+            translated_srt,
+            voices=["Roger", "Aria", "Jessica"],  # Default voices
+            output=output_path
+        )
+
+        set_job_status(job_id, "done", output_filename)
+        logger.info(f"Translation complete for job {job_id}! Audio saved as {output_filename}")
+
+    except Exception as e:
+        set_job_status(job_id, "failed")
+        logger.error(f"Error during translation of job {job_id}: {str(e)}")
+
+
+def finish_transcription(job_id, status):
+    """Start translation for a job Rev.ai has finished, or mark it failed. Safe to call more than once."""
+    if status != "transcribed":
+        # Only a job still waiting on Rev.ai can fail here; late or duplicate callbacks must not undo later progress
+        if set_job_status(job_id, "failed", expected_status="transcribing"):
+            logger.error(f"Transcription job {job_id} failed with status: {status}")
+        return
+
+    # Rev.ai may deliver a callback more than once, and a poll may race it; only start the pipeline the first time
+    if not set_job_status(job_id, "translating", expected_status="transcribing"):
+        logger.info(f"Job {job_id} is no longer transcribing, not starting translation again")
+        return
+
+    job_info = get_job(job_id)
+    logger.info(f"Job {job_id} transcribed, queueing translation")
+    pipeline_executor.submit(run_pipeline, job_id, job_info['from_lang'], job_info['to_lang'], job_info['original_filename'])
+
+
+def poll_job(job_id):
+    """Wait for a job with backoff polling instead of a callback, then finish it."""
+    try:
+        finish_transcription(job_id, wait_for_job(job_id))
+    except Exception as e:
+        # The job stays transcribing; /status checks Rev.ai again on the next request
+        logger.error(f"Error polling job {job_id}: {str(e)}")
+
 
 @app.route('/', methods=['GET', 'POST'])
 def translate_audio():
     if request.method == 'POST':
-        temp_dir = "temp"
-        temp_files = []  # Keep track of temporary files
-        
         try:
             # Get the uploaded file and language selections
             logger.info("Processing new audio translation request")
             audio_file = request.files['audio']
             from_lang = request.form['from_lang']
             to_lang = request.form['to_lang']
-            
+
             if not audio_file:
                 flash("No audio file uploaded", "error")
                 return render_template('upload.html')
-            
-            flash("Starting translation process...", "info")
-            
-            # Create temp directory if it doesn't exist
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            
-            # Save uploaded file temporarily with original extension
-            logger.info("Saving uploaded file")
-            original_filename = audio_file.filename
-            file_ext = os.path.splitext(original_filename)[1].lower()
-            temp_original = os.path.join(temp_dir, f"{os.path.splitext(original_filename)[0]}_temp{file_ext}")
-            audio_file.save(temp_original)
-            temp_files.append(temp_original)
-            
-            # Transcribe with Rev.ai
-            logger.info("Transcribing audio with Rev.ai")
-            transcript_files = transcribe_to_files(temp_original, save_dir = "./results", language = rev_ai_lang_map.get(from_lang, 'en'), output_format="both", fix_transcript=True)
-            # transcript_files = retrieve_transcription("BOyLYQMK8aqa9Uve", save_dir = "./results", output_format="both", fix_transcript=True)
-            
-            # Translate srt using OpenAI
-            logger.info("Starting translation")
-            translated_srt_path = translate_srt(transcript_files[0], from_lang, to_lang)
-            
-            # Generate audio from translated text using ElevenLabs
-            logger.info("Converting translation to speech using ElevenLabs")
-            flash("Generating audio from translation...", "info")
-            
-            # Create timestamp and format output filename for translated audio mp3
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            original_name = os.path.splitext(os.path.basename(original_filename))[0]
-            output_filename = f"{original_name}_{timestamp}_translated.mp3"
-            output_path = os.path.join("results", output_filename)
-            
-            # Generate speech using ElevenLabs with multiple default voices
-            generate_speech(
-                input_file=translated_srt_path,  # Use the SRT file
-                voices=["Roger", "Aria", "Jessica"],  # Default voices
-                output=output_path
-            )
-            
-            flash(f"Translation complete! Audio saved as {output_filename}", "success")
-            
-            # Clean up temporary files
-            logger.info("Cleaning up temporary files")
-            for temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except Exception as e:
-                    logger.error(f"Error removing temporary file {temp_file}: {str(e)}")
-            
-            try:
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-            except Exception as e:
-                logger.error(f"Error removing temp directory: {str(e)}")
-            
-            return render_template('upload.html')
-            
+
+            # The upload is only needed until Rev.ai has it; the directory is removed even on errors
+            with tempfile.TemporaryDirectory(prefix="podtx_") as temp_dir:
+                # Save uploaded file temporarily with original extension
+                logger.info("Saving uploaded file")
+                original_filename = audio_file.filename
+                file_ext = os.path.splitext(original_filename)[1].lower()
+                temp_original = os.path.join(temp_dir, f"{os.path.splitext(original_filename)[0]}_temp{file_ext}")
+                with open(temp_original, 'wb', buffering=UPLOAD_CHUNK_SIZE) as f:
+                    shutil.copyfileobj(audio_file.stream, f, length=UPLOAD_CHUNK_SIZE)
+
+                # Submit to Rev.ai; translation and TTS run once Rev.ai calls us back (or polling sees the job finish)
+                logger.info("Submitting audio to Rev.ai")
+                callback_url = f"{PUBLIC_BASE_URL.rstrip('/')}{url_for('rev_callback')}" if PUBLIC_BASE_URL else None
+                job_id = submit_transcription(
+                    temp_original,
+                    language=rev_ai_lang_map.get(from_lang, 'en'),
+                    callback_url=callback_url
+                )
+            save_job(job_id, from_lang, to_lang, original_filename)
+            if callback_url is None:
+                poll_executor.submit(poll_job, job_id)
+
+            status_url = url_for('job_status', job_id=job_id)
+            flash(f"Transcription job {job_id} submitted. The translated audio will be saved to results/ when it is done. Check progress at {status_url}", "info")
+
+            return render_template('upload.html'), 202
+
         except Exception as e:
             logger.error(f"Error during translation: {str(e)}")
             flash(f"An error occurred during translation: {str(e)}", "error")
             return render_template('upload.html')
-    
+
     return render_template('upload.html')
 
+
+@app.route('/rev_callback', methods=['POST'])
+def rev_callback():
+    # Rev.ai posts {"job": {"id": ..., "status": ...}} when a job finishes. The route is unauthenticated,
+    # so the payload only says which job to check; its status comes from Rev.ai itself
+    job_id = (request.get_json(silent=True) or {}).get('job', {}).get('id')
+
+    if get_job(job_id) is None:
+        logger.warning(f"Received callback for unknown job {job_id}")
+        return '', 404
+
+    try:
+        status = get_job_status(job_id)
+    except Exception as e:
+        # The job stays transcribing; /status checks Rev.ai again on the next request
+        logger.error(f"Could not check status of job {job_id} with Rev.ai: {str(e)}")
+        return '', 502
+
+    if status != "in_progress":
+        finish_transcription(job_id, status)
+    return '', 200
+
+
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    job_info = get_job(job_id)
+    if job_info is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+
+    # Recover from a callback that never arrived by asking Rev.ai directly
+    if job_info['status'] == "transcribing":
+        try:
+            status = get_job_status(job_id)
+            if status != "in_progress":
+                finish_transcription(job_id, status)
+                job_info = get_job(job_id)
+        except Exception as e:
+            logger.warning(f"Could not refresh status of job {job_id} from Rev.ai: {str(e)}")
+
+    output_filename = job_info['output_filename']
+    return jsonify({
+        "job_id": job_id,
+        "status": job_info['status'],
+        "output_filename": output_filename,
+        "download_url": url_for('download_result', filename=output_filename) if output_filename else None
+    })
+
+
+@app.route('/results/<path:filename>')
+def download_result(filename):
+    # conditional=True enables Range/ETag handling; Werkzeug serves the file with sendfile where it can
+    return send_from_directory(
+        os.path.abspath(RESULTS_DIR),
+        filename,
+        as_attachment=True,
+        conditional=True
+    )
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -33,12 +33,72 @@ from datetime import datetime
 import time
 import logging
 import argparse
+import re
+import asyncio
+import hashlib
 import openai
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+from diskcache import Cache
 
 rev_access_token = os.getenv("REVAI_ACCESS_TOKEN")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_MAX_RETRIES = 5
+
+# Polling interval (seconds) while waiting for a job without a callback
+POLL_INITIAL_DELAY = 2
+POLL_MAX_DELAY = 30
+
+# Transcripts are fixed in chunks of at most this many characters - about 1K tokens of English, but
+# roughly one token per character (4K+ tokens) for Mandarin, the default language; the reply is about
+# as long again, well inside gpt-4o-mini's output limit. Up to FIX_MAX_CONCURRENCY requests are in flight
+FIX_CHUNK_CHARS = 4000
+FIX_MAX_CONCURRENCY = 4
+FIX_TRANSCRIPT_PROMPT = (
+    "You are a transcript editor. Your task is to add proper punctuation and correct any misassigned characters, "
+    "especially when a sentence-ending word or punctuation is misplaced in the timestamped transcript. "
+    "The transcript is given as a JSON object mapping line ids to lines. Return a JSON object with the same ids "
+    "mapping to the fixed lines, keeping each line's speaker and timestamp unchanged."
+)
+
+# Seconds to wait for Rev.ai to connect / respond before giving up on a request
+REV_REQUEST_TIMEOUT = 30
+# Longest Retry-After (seconds) honored between retries
+REV_RETRY_AFTER_MAX = 60
+# Quick status checks made while serving a web request
+REV_STATUS_TIMEOUT = 5
+
+
+class CappedRetry(Retry):
+    """Retry that honors Retry-After, but never sleeps longer than REV_RETRY_AFTER_MAX"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, REV_RETRY_AFTER_MAX)
+
+
+# Shared connection pool, so repeated Rev.ai polls reuse open connections. Rate limited and
+# failed requests are retried with exponential backoff, honoring Retry-After; job submission
+# (POST) is not retried so a job is never submitted twice
+rev_session = requests.Session()
+rev_session.mount("https://", HTTPAdapter(max_retries=CappedRetry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)))
+
+# No retries, for status checks that must not hold up a web request
+rev_status_session = requests.Session()
+
+# Fixed transcript chunks, so re-running the same job does not call OpenAI again
+fix_cache = Cache("./.tcache")
 
 # Configure logging
 logging.basicConfig(
@@ -48,18 +108,93 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def fix_transcript_text(transcript):
-    """Use OpenAI model to fix transcript formatting"""
-    client = openai.OpenAI()
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a transcript editor. Your task is to add proper punctuation and correct any misassigned characters, especially when a sentence-ending word or punctuation is misplaced in the timestamped transcript."},
-            {"role": "user", "content": transcript}
-        ]
-    )
-    fixed_transcript = response.choices[0].message.content
-    return fixed_transcript
+class RevAiClient(apiclient.RevAiAPIClient):
+    """RevAiAPIClient that sends every request over a shared session, with a timeout"""
+
+    def __init__(self, access_token, session=rev_session, timeout=REV_REQUEST_TIMEOUT):
+        super().__init__(access_token)
+        self.session = session
+        self.timeout = timeout
+
+    def _make_http_request(self, method, url, **kwargs):
+        headers = self.default_headers.copy()
+        headers.update(kwargs.pop('headers', {}))
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, url, headers=headers, **kwargs)
+
+        try:
+            response.raise_for_status()
+            return response
+        except HTTPError as err:
+            if response.content:
+                err.args = (err.args[0] + "; Server Response : {}".format(response.content.decode('utf-8')),)
+            raise
+
+def chunk_transcript_lines(lines, max_chars=FIX_CHUNK_CHARS):
+    """Group transcript lines into chunks of at most max_chars each"""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) > max_chars:
+            chunks.append(current)
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def fix_transcript_chunk(client, semaphore, lines):
+    """
+    Fix one chunk of transcript lines using JSON mode.
+
+    Lines missing from the response are kept as-is. Fixing is optional, so a truncated or
+    malformed reply keeps the whole chunk unchanged instead of failing the job.
+    """
+    key = ("fix", hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest(), OPENAI_MODEL)
+    cached = fix_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    async with semaphore:
+        response = await client.chat.completions.with_raw_response.create(
+            model=OPENAI_MODEL,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": FIX_TRANSCRIPT_PROMPT},
+                {"role": "user", "content": orjson.dumps({str(i): line for i, line in enumerate(lines)}).decode()}
+            ]
+        )
+    choice = orjson.loads(response.content)["choices"][0]
+    try:
+        fixed = orjson.loads(choice["message"]["content"] or "")
+    except orjson.JSONDecodeError:
+        fixed = None
+    if not isinstance(fixed, dict):
+        logger.warning(f"Unusable transcript fix reply (finish_reason: {choice.get('finish_reason')}), keeping {len(lines)} lines unchanged")
+        return lines
+
+    fixed_lines = []
+    for i, line in enumerate(lines):
+        fixed_line = fixed.get(str(i))
+        fixed_lines.append(fixed_line if isinstance(fixed_line, str) else line)
+    fix_cache.set(key, fixed_lines)
+    return fixed_lines
+
+async def fix_transcript_chunks(chunks, max_concurrency=FIX_MAX_CONCURRENCY):
+    """Fix transcript chunks concurrently, at most max_concurrency requests at a time"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with openai.AsyncOpenAI(http_client=openai.DefaultAsyncHttpxClient(http2=True), max_retries=OPENAI_MAX_RETRIES) as client:
+        return await asyncio.gather(*(fix_transcript_chunk(client, semaphore, lines) for lines in chunks))
+
+def fix_transcript_lines(lines):
+    """Use OpenAI model to fix transcript lines. Returns one fixed line per input line."""
+    chunks = chunk_transcript_lines(lines)
+    logger.info(f"Fixing transcript in {len(chunks)} chunk(s)")
+    fixed_chunks = asyncio.run(fix_transcript_chunks(chunks))
+    return [line for lines in fixed_chunks for line in lines]
 
 def format_transcript_txt(transcript_text):
     """
@@ -87,40 +222,117 @@ def format_transcript_txt(transcript_text):
     return '\n'.join(formatted_text)
 
 
-def create_srt_from_transcript(transcript):
-    # Split into lines and filter empty lines
-    lines = [line.strip() for line in transcript.split('\n') if line.strip()]
-    
-    srt_entries = []
-    counter = 1
+# One transcript line: "<speaker>    HH:MM:SS    <text>"
+TRANSCRIPT_LINE_RE = re.compile(r'^[ \t]*(.+?) {4}(\d+):(\d{2}):(\d{2})(?:\.\d+)? {4}(.+?)[ \t]*$')
+
+def format_srt_time(ms):
+    """Format milliseconds as an SRT timestamp (HH:MM:SS,mmm)"""
+    seconds, ms = divmod(ms, 1000)
+    return "%02d:%02d:%02d,%03d" % (seconds // 3600, seconds // 60 % 60, seconds % 60, ms)
+
+def parse_transcript_json(transcript_json):
+    """
+    Flatten a Rev.ai transcript JSON into one entry per monologue.
     
-    for line in lines:
-        # Split each line into components
-        parts = line.split('    ')
-        if len(parts) != 3:
-            continue
-            
-        speaker, timestamp, text = parts
+    Args:
+        transcript_json (dict): Transcript from get_transcript_json
         
-        # Convert timestamp
-        time_parts = timestamp.strip().split(':')
-        if len(time_parts) != 3:
+    Returns:
+        list: dicts with speaker, start and end (seconds) and text
+    """
+    monologues = []
+    for monologue in transcript_json.get("monologues", []):
+        elements = monologue.get("elements", [])
+        timed = [e for e in elements if e.get("type") == "text" and "ts" in e]
+        text = "".join(e.get("value", "") for e in elements).strip()
+        if not timed or not text:
             continue
-            
-        hours, minutes, seconds = time_parts
-        start_time = f"{hours}:{minutes}:{seconds},000"
-        
-        # Calculate end time (using next timestamp or +5 seconds for last entry)
-        end_time = f"{hours}:{minutes}:{float(seconds)+5:.3f}".replace('.', ',')
-        
-        # Format SRT entry
-        srt_entry = f"{counter}\n{start_time} --> {end_time}\n{speaker}: {text}\n"
-        srt_entries.append(srt_entry)
-        counter += 1
+        monologues.append({
+            "speaker": f"Speaker {monologue.get('speaker', 0)}",
+            "start": timed[0]["ts"],
+            "end": timed[-1].get("end_ts", timed[-1]["ts"]),
+            "text": text
+        })
+    return monologues
+
+def format_transcript_line(monologue):
+    """Format a monologue as a Rev.ai text transcript line: "<speaker>    HH:MM:SS    <text>" """
+    seconds = int(monologue["start"])
+    return "%s    %02d:%02d:%02d    %s" % (monologue["speaker"], seconds // 3600, seconds // 60 % 60, seconds % 60, monologue["text"])
+
+def create_srt_from_monologues(monologues):
+    srt_entries = []
+    for i, monologue in enumerate(monologues, 1):
+        # Cue timing comes straight from Rev.ai's word timestamps
+        start_time = format_srt_time(round(monologue["start"] * 1000))
+        end_time = format_srt_time(round(monologue["end"] * 1000))
+        srt_entries.append("%d\n%s --> %s\n%s: %s\n" % (i, start_time, end_time, monologue["speaker"], monologue["text"]))
     
     return "\n".join(srt_entries)
 
 
+def submit_transcription(file_path, language="cmn", callback_url=None):
+    """
+    Submit an audio file to Rev.ai without waiting for the job to finish.
+    
+    Args:
+        file_path (str): Path to the local audio file
+        language (str): Language code for transcription (e.g. "eng", "cmn")
+        callback_url (str): URL Rev.ai will POST the finished job to
+        
+    Returns:
+        str: The Rev.ai job ID
+    """
+    client = RevAiClient(rev_access_token)
+    
+    logger.info(f"Submitting transcription job for {file_path}")
+    job = client.submit_job_local_file(
+        file_path,
+        language=language,
+        callback_url=callback_url
+    )
+    return job.id
+
+def get_job_status(job_id):
+    """Current status of a Rev.ai job - in_progress, transcribed or failed. One quick request, no retries."""
+    client = RevAiClient(rev_access_token, session=rev_status_session, timeout=REV_STATUS_TIMEOUT)
+    return client.get_job_details(job_id).status
+
+def wait_for_job(job_id, client=None):
+    """
+    Poll a Rev.ai job until it is no longer in progress.
+    
+    Args:
+        job_id (str): The Rev.ai job ID
+        client (RevAiClient): Client to poll with (default: a new client)
+        
+    Returns:
+        str: Final job status - transcribed or failed
+    """
+    if client is None:
+        client = RevAiClient(rev_access_token)
+    
+    # Poll quickly at first so short audio is picked up within seconds
+    logger.info(f"Waiting for job {job_id} to complete")
+    delay = POLL_INITIAL_DELAY
+    job_details = client.get_job_details(job_id)
+    while job_details.status == "in_progress":
+        time.sleep(delay)
+        delay = min(delay * 1.5, POLL_MAX_DELAY)
+        try:
+            job_details = client.get_job_details(job_id)
+        except HTTPError as err:
+            # Rate limited: wait at least as long as Rev.ai asks before the next poll
+            if err.response is None or err.response.status_code != 429:
+                raise
+            retry_after = err.response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.warning(f"Rate limited by Rev.ai, next poll in {delay:.0f} seconds")
+            continue
+        logger.debug(f"Job status: {job_details.status}")
+    return job_details.status
+
 def transcribe_to_files(file_path, save_dir = "./results", language="cmn", output_format="srt", fix_transcript=False):
     """
     Transcribe an audio file to SRT and/or TXT format using Rev.ai API.
@@ -137,50 +349,38 @@ def transcribe_to_files(file_path, save_dir = "./results", language="cmn", outpu
     """
     # Create Rev.ai client
     logger.info("Initializing Rev.ai client")
-    client = apiclient.RevAiAPIClient(rev_access_token)
+    client = RevAiClient(rev_access_token)
     
     # Submit transcription job
-    logger.info(f"Submitting transcription job for {file_path}")
-    job = client.submit_job_local_file(
-        file_path,
-        language=language
-    )
-    
-    # Wait for job to complete
-    logger.info(f"Waiting for job {job.id} to complete")
-    job_details = client.get_job_details(job.id)
-    while job_details.status == "in_progress":
-        job_details = client.get_job_details(job.id)
-        logger.debug(f"Job status: {job_details.status}")
-        time.sleep(30)  # Wait 30 seconds before checking again
+    job_id = submit_transcription(file_path, language=language)
+    status = wait_for_job(job_id, client)
         
     # Get transcript once complete
-    if job_details.status == "transcribed":
+    if status == "transcribed":
         logger.info("Job completed successfully, retrieving transcript")
-        transcript_text = client.get_transcript_text(job.id)
+        transcript_json = client.get_transcript_json(job_id)
     else:
-        logger.error(f"Transcription failed with status: {job_details.status}")
-        raise Exception(f"Transcription failed with status: {job_details.status}")
+        logger.error(f"Transcription failed with status: {status}")
+        raise Exception(f"Transcription failed with status: {status}")
     
     filename = os.path.splitext(os.path.basename(file_path))[0]
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    return save_transcript_files(transcript_text, save_dir, filename, timestamp, output_format, fix_transcript)
+    captions, formatted_transcript = render_transcript(parse_transcript_json(transcript_json), fix_transcript)
+    return write_transcript_files(captions, formatted_transcript, save_dir, filename, timestamp, output_format)
 
-def retrieve_transcription(job_id, save_dir="./results", output_format="both", fix_transcript=False):
+def get_transcript(job_id, fix_transcript=False):
     """
-    Retrieve and save transcription for a completed Rev.ai job.
+    Fetch the transcript for a completed Rev.ai job without writing any files.
     
     Args:
         job_id (str): The Rev.ai job ID to retrieve transcription for
-        save_dir (str): Directory to save output files (default: ./results)
-        output_format (str): Output format - 'srt', 'txt', or 'both' (default: both)
         fix_transcript (bool): Whether to use OpenAI to fix transcript formatting
         
     Returns:
-        str or tuple: Path(s) to the saved transcription file(s)
+        tuple: (SRT captions, formatted TXT transcript)
     """
-    client = apiclient.RevAiAPIClient(rev_access_token)
+    client = RevAiClient(rev_access_token)
     
     # Get job details and check status
     logger.info(f"Checking status for job {job_id}")
@@ -192,39 +392,78 @@ def retrieve_transcription(job_id, save_dir="./results", output_format="both", f
         
     # Get transcript
     logger.info("Retrieving transcript")
-    transcript_text = client.get_transcript_text(job_id)
+    transcript_json = client.get_transcript_json(job_id)
+    
+    return render_transcript(parse_transcript_json(transcript_json), fix_transcript)
+
+def retrieve_transcription(job_id, save_dir="./results", output_format="both", fix_transcript=False):
+    """
+    Retrieve and save transcription for a completed Rev.ai job.
+    
+    Args:
+        job_id (str): The Rev.ai job ID to retrieve transcription for
+        save_dir (str): Directory to save output files (default: ./results)
+        output_format (str): Output format - 'srt', 'txt', or 'both' (default: both)
+        fix_transcript (bool): Whether to use OpenAI to fix transcript formatting
+        
+    Returns:
+        str or tuple: Path(s) to the saved transcription file(s)
+    """
+    captions, formatted_transcript = get_transcript(job_id, fix_transcript)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    return save_transcript_files(transcript_text, save_dir, f"transcript_{job_id}", timestamp, output_format, fix_transcript)
+    return write_transcript_files(captions, formatted_transcript, save_dir, f"transcript_{job_id}", timestamp, output_format)
+
+def render_transcript(monologues, fix_transcript=False):
+    """
+    Convert Rev.ai monologues to SRT captions and formatted TXT
+    
+    Args:
+        monologues (list): Monologues from parse_transcript_json
+        fix_transcript (bool): Whether to use OpenAI to fix transcript formatting
+        
+    Returns:
+        tuple: (SRT captions, formatted TXT transcript)
+    """
+    lines = [format_transcript_line(monologue) for monologue in monologues]
+    
+    # Fix transcript if requested
+    if fix_transcript:
+        logger.info("Fixing transcript with OpenAI model")
+        fixed_monologues = []
+        for monologue, line in zip(monologues, fix_transcript_lines(lines)):
+            # Keep the original text if the model mangled the speaker/timestamp prefix
+            match = TRANSCRIPT_LINE_RE.match(line)
+            fixed_monologues.append(dict(monologue, text=match.group(5)) if match else monologue)
+        monologues = fixed_monologues
+        lines = [format_transcript_line(monologue) for monologue in monologues]
+    
+    # Convert transcript to SRT format with speaker labels
+    logger.info("Converting transcript to SRT format")
+    captions = create_srt_from_monologues(monologues)
+    formatted_transcript = format_transcript_txt('\n'.join(lines))
+    
+    return captions, formatted_transcript
 
-def save_transcript_files(transcript_text, save_dir, base_filename, timestamp, output_format, fix_transcript=False):
+def write_transcript_files(captions, formatted_transcript, save_dir, base_filename, timestamp, output_format):
     """
-    Save transcript text to files in specified format(s)
+    Write rendered SRT captions and/or TXT transcript to files
     
     Args:
-        transcript_text (str): The transcript text to save
+        captions (str): SRT captions from render_transcript
+        formatted_transcript (str): Formatted TXT transcript from render_transcript
         save_dir (str): Directory to save files
         base_filename (str): Base name for output files
         timestamp (str): Timestamp to append to filenames
         output_format (str): Output format - 'srt', 'txt', or 'both'
-        fix_transcript (bool): Whether to use OpenAI to fix transcript formatting
         
     Returns:
         str or tuple: Path(s) to saved file(s)
     """
     os.makedirs(save_dir, exist_ok=True)
     output_paths = []
-
-    # Fix transcript if requested
-    if fix_transcript:
-        logger.info("Fixing transcript with OpenAI model")
-        transcript_text = fix_transcript_text(transcript_text)
     
     if output_format in ["srt", "both"]:
-        # Convert transcript to SRT format with speaker labels
-        logger.info("Converting transcript to SRT format")
-        captions = create_srt_from_transcript(transcript_text)
-        
         # Save SRT file
         srt_path = os.path.join(save_dir, f"{base_filename}_{timestamp}.srt")
         logger.info(f"Saving SRT file to {srt_path}")
@@ -236,7 +475,6 @@ def save_transcript_files(transcript_text, save_dir, base_filename, timestamp, o
         # Save transcript as TXT
         txt_path = os.path.join(save_dir, f"{base_filename}_{timestamp}.txt")
         logger.info(f"Saving TXT file to {txt_path}")
-        formatted_transcript = format_transcript_txt(transcript_text)
         with open(txt_path, 'w', encoding='utf-8') as f:
             f.write(formatted_transcript)
         output_paths.append(txt_path)
@@ -1,7 +1,14 @@
 import openai
+import orjson
+import asyncio
 import logging
-import os   
+import time
+import os
+import re
+import hashlib
+import functools
 from datetime import datetime
+from diskcache import Cache
 logger = logging.getLogger(__name__)
 
 # Configure OpenAI API key
@@ -9,47 +16,412 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 
 OPENAI_MODEL = "gpt-4o-mini"
 
+# The OpenAI SDK retries 429/5xx with exponential backoff, honoring Retry-After
+OPENAI_MAX_RETRIES = 5
+
+SYSTEM_MSG_TEMPLATE = (
+    "You are a translator. Translate each numbered segment from {from_lang} to {to_lang}. "
+    "Maintain the original meaning and tone. Keep every <<i>> marker and return only the numbered translations."
+)
+
+# Cues are translated in chunks of at most this many cues / characters (the translation is about
+# as long as the input, so the character cap keeps each reply well inside the model's output limit),
+# with up to TRANSLATE_MAX_CONCURRENCY requests in flight
+TRANSLATE_CHUNK_CUES = 40
+TRANSLATE_CHUNK_CHARS = 6000
+TRANSLATE_MAX_CONCURRENCY = 4
+
+# Requests per chunk before a misnumbered reply is given up on and the chunk keeps its original text
+TRANSLATE_ATTEMPTS = 2
+
+# Seconds between status checks on an OpenAI Batch API job
+BATCH_POLL_INTERVAL = 60
+
+# Shared connection pool, so consecutive translations reuse open connections
+openai_http_client = openai.DefaultHttpxClient(http2=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client():
+    """Shared OpenAI client, created on first use so importing this module does not need OPENAI_API_KEY"""
+    return openai.OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=openai_http_client,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=120
+    )
+
+
+# Translations of individual cue texts, shared across runs
+translation_cache = Cache("./.tcache")
+
+SPEAKER_RE = re.compile(r'^(Speaker \d+): (.*)\Z', re.DOTALL)
+SEGMENT_RE = re.compile(r'<<(\d+)>>\s*(.*?)(?=<<\d+>>|\Z)', re.DOTALL)
+
+
+def iter_cues(srt_file):
+    """Yield the cue blocks of an SRT file one at a time"""
+    buf = []
+    with open(srt_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                buf.append(line)
+            elif buf:
+                yield "".join(buf)
+                buf.clear()
+    if buf:
+        yield "".join(buf)
+
+
+def parse_cue(block):
+    """
+    Parse one SRT cue block.
+
+    Args:
+        block (str): Cue block (index, timing and text lines)
+
+    Returns:
+        tuple: (index, timing, speaker, text); speaker is None if the cue has no label.
+        None if the block is not a complete cue.
+    """
+    lines = block.strip().split('\n')
+    if len(lines) < 3:
+        return None
+    cue_text = '\n'.join(lines[2:])
+    match = SPEAKER_RE.match(cue_text)
+    speaker, cue_text = match.groups() if match else (None, cue_text)
+    return (lines[0], lines[1], speaker, cue_text)
+
+
+def parse_srt_cues(blocks):
+    """
+    Parse SRT cue blocks into cues.
+
+    Args:
+        blocks (iterable): Cue blocks, e.g. from iter_cues or split_cues
+
+    Returns:
+        list: (index, timing, speaker, text) tuples; speaker is None if the cue has no label
+    """
+    return [cue for cue in map(parse_cue, blocks) if cue is not None]
+
+
+def split_cues(text):
+    """Split in-memory SRT text into cue blocks"""
+    return re.split(r'\n\s*\n', text.strip())
+
+
+def cache_key(text, from_lang, to_lang):
+    return (hashlib.sha256(text.encode('utf-8')).hexdigest(), from_lang, to_lang, OPENAI_MODEL)
+
+
+@functools.lru_cache(maxsize=None)
+def system_message(from_lang, to_lang):
+    """System message for a language pair, built once and shared by every request"""
+    return {"role": "system", "content": SYSTEM_MSG_TEMPLATE.format(from_lang=from_lang, to_lang=to_lang)}
+
+
+def build_messages(texts, from_lang, to_lang):
+    """Chat messages asking for the numbered texts to be translated"""
+    return [
+        system_message(from_lang, to_lang),
+        {"role": "user", "content": "\n".join(f"<<{i}>> {text}" for i, text in enumerate(texts))}
+    ]
+
+
+def parse_segments(content):
+    """Parse a "<<i>> text" response into translated text by position"""
+    return {int(i): translated.strip() for i, translated in SEGMENT_RE.findall(content)}
+
+
+def parse_chunk_reply(content, count):
+    """
+    Parse the reply for a chunk of count texts, checking its numbering.
+
+    Returns:
+        dict: Translated text by position in the chunk, or None if the reply's ids are not
+        exactly 0..count-1 (numbered from 1, merged or split segments, ...)
+    """
+    ids = [int(i) for i, _ in SEGMENT_RE.findall(content)]
+    if sorted(ids) != list(range(count)):
+        return None
+    return parse_segments(content)
+
+
+def translate_texts(texts, from_lang, to_lang):
+    """
+    Translate a list of texts in one OpenAI request.
+
+    Args:
+        texts (list): Texts to translate
+        from_lang (str): Source language code
+        to_lang (str): Target language code
+
+    Returns:
+        dict: Translated text by position in texts; empty if no reply was numbered correctly
+    """
+    logger.info(f"Translating {len(texts)} segments with OpenAI")
+    client = get_openai_client()
+    for attempt in range(1, TRANSLATE_ATTEMPTS + 1):
+        # Raw response: only the message content is needed, so skip building the typed ChatCompletion
+        response = client.chat.completions.with_raw_response.create(
+            model= OPENAI_MODEL,
+            messages=build_messages(texts, from_lang, to_lang)
+        )
+        content = orjson.loads(response.content)["choices"][0]["message"]["content"]
+        translated = parse_chunk_reply(content, len(texts))
+        if translated is not None:
+            return translated
+        logger.warning(f"Reply for {len(texts)} segments was misnumbered (attempt {attempt} of {TRANSLATE_ATTEMPTS})")
+
+    logger.error(f"Could not translate a chunk of {len(texts)} segments, keeping original text")
+    return {}
+
+
+def chunk_ranges(texts, max_cues=TRANSLATE_CHUNK_CUES, max_chars=TRANSLATE_CHUNK_CHARS):
+    """Split texts into (start, end) ranges of at most max_cues texts and max_chars characters"""
+    ranges = []
+    start = 0
+    size = 0
+    for i, text in enumerate(texts):
+        if i > start and (i - start >= max_cues or size + len(text) > max_chars):
+            ranges.append((start, i))
+            start = i
+            size = 0
+        size += len(text)
+    if start < len(texts):
+        ranges.append((start, len(texts)))
+    return ranges
+
+
+async def translate_chunks(texts, from_lang, to_lang, max_concurrency=TRANSLATE_MAX_CONCURRENCY):
+    """
+    Translate texts in chunks from chunk_ranges, running the requests concurrently.
+
+    Args:
+        texts (list): Texts to translate
+        from_lang (str): Source language code
+        to_lang (str): Target language code
+        max_concurrency (int): Maximum number of requests in flight
+
+    Returns:
+        dict: Translated text by position in texts; positions missing from the responses are left out
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def translate_chunk(start, end):
+        async with semaphore:
+            # The shared client is thread-safe, so chunks reuse its connection pool from worker threads
+            translated = await asyncio.to_thread(translate_texts, texts[start:end], from_lang, to_lang)
+        # translate_texts only returns ids 0..end-start-1, so shifted ids stay inside this chunk
+        return {start + i: text for i, text in translated.items()}
+
+    results = await asyncio.gather(*(translate_chunk(start, end) for start, end in chunk_ranges(texts)))
+    return {i: text for result in results for i, text in result.items()}
+
+
+def lookup_cached(cues, from_lang, to_lang):
+    """
+    Look up cue texts in the translation cache.
+
+    Returns:
+        tuple: (translations by cue text, unique cue texts missing from the cache)
+    """
+    translations = {}
+    for _, _, _, cue_text in cues:
+        cached = translation_cache.get(cache_key(cue_text, from_lang, to_lang))
+        if cached is not None:
+            translations[cue_text] = cached
+
+    misses = list(dict.fromkeys(cue_text for _, _, _, cue_text in cues if cue_text not in translations))
+    logger.info(f"{len(cues) - len(misses)} of {len(cues)} cues found in translation cache")
+    return translations, misses
+
+
+def store_translations(translations, misses, translated, from_lang, to_lang):
+    """
+    Add translated misses (by position) to translations and the cache.
+
+    translated must only hold segments from replies whose ids matched the chunk sent
+    (see parse_chunk_reply); anything cached here is reused by every later run.
+    """
+    failed = 0
+    for i, cue_text in enumerate(misses):
+        if not translated.get(i):
+            failed += 1
+            continue
+        translations[cue_text] = translated[i]
+        translation_cache.set(cache_key(cue_text, from_lang, to_lang), translated[i])
+    if failed:
+        logger.warning(f"{failed} of {len(misses)} segments were not translated, keeping original text (not cached)")
+
+
+def build_srt(cues, translations):
+    """Reassemble cues into SRT text, swapping in translations where available"""
+    srt_entries = []
+    for index, timing, speaker, cue_text in cues:
+        translated_text = translations.get(cue_text, cue_text)
+        if speaker is not None:
+            translated_text = f"{speaker}: {translated_text}"
+        srt_entries.append(f"{index}\n{timing}\n{translated_text}\n")
+    return "\n".join(srt_entries)
+
+
+def translated_srt_path(srt_file, from_lang, to_lang):
+    """Path for the translated copy of srt_file, next to the original"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename_without_ext = os.path.splitext(os.path.basename(srt_file))[0]
+    new_filename = f"{filename_without_ext}_{from_lang}_to_{to_lang}_{timestamp}.srt"
+    return os.path.join(os.path.dirname(srt_file), new_filename)
+
+
+def translate_srt_text(text: str, from_lang: str, to_lang: str) -> str:
+    """
+    Translate SRT text using OpenAI's API
+
+    Cue texts already translated in an earlier run are served from the
+    translation cache; only the rest are sent to OpenAI.
+
+    Args:
+        text (str): SRT content to translate
+        from_lang (str): Source language code
+        to_lang (str): Target language code
+
+    Returns:
+        str: Translated SRT content
+    """
+    return translate_cues(parse_srt_cues(split_cues(text)), from_lang, to_lang)
+
+
+def translate_cues(cues, from_lang, to_lang):
+    """Translate parsed cues and reassemble them into SRT text"""
+    translations, misses = lookup_cached(cues, from_lang, to_lang)
+    if misses:
+        translated = asyncio.run(translate_chunks(misses, from_lang, to_lang))
+        store_translations(translations, misses, translated, from_lang, to_lang)
+
+    return build_srt(cues, translations)
+
+
 def translate_srt(srt_file: str, from_lang: str, to_lang: str) -> str:
     """
-    Translate text using OpenAI's API
-    
+    Translate an SRT file using OpenAI's API
+
     Args:
         srt_file (str): Path to SRT file to translate
         from_lang (str): Source language code
         to_lang (str): Target language code
-        
+
     Returns:
-        str: Translated text
+        str: Path to the translated SRT file
     """
-    with open(srt_file, 'r', encoding='utf-8') as f:
-        text = f.read()
-
     try:
-        logger.info("Translating text with OpenAI")
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model= OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": f"You are a translator. Translate the following text from {from_lang} to {to_lang}. Maintain the original meaning and tone."},
-                {"role": "user", "content": text}
-            ]
-        )
-        translated_text = response.choices[0].message.content
-        
-        # Generate new filename with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        original_filename = os.path.basename(srt_file)
-        filename_without_ext = os.path.splitext(original_filename)[0]
-        new_filename = f"{filename_without_ext}_{from_lang}_to_{to_lang}_{timestamp}.srt"
-        new_filepath = os.path.join(os.path.dirname(srt_file), new_filename)
-        
+        translated_text = translate_cues(parse_srt_cues(iter_cues(srt_file)), from_lang, to_lang)
+        new_filepath = translated_srt_path(srt_file, from_lang, to_lang)
+
         # Save translated text
         logger.info(f"Saving translated file to {new_filepath}")
         with open(new_filepath, 'w', encoding='utf-8') as f:
             f.write(translated_text)
-            
+
         return new_filepath
 
     except Exception as e:
         logger.error(f"Translation error: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
+
+
+def run_batch(batch_requests, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Run chat completion requests through the OpenAI Batch API and wait for the results.
+
+    Args:
+        batch_requests (dict): Chat completion bodies by custom_id
+        poll_interval (int): Seconds between status checks
+
+    Returns:
+        dict: Response message content by custom_id, for the requests that succeeded
+    """
+    client = get_openai_client()
+    jsonl = b"".join(
+        orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + b"\n"
+        for custom_id, body in batch_requests.items()
+    )
+    input_file = client.files.create(file=("translate_batch.jsonl", jsonl), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    logger.info(f"Submitted OpenAI batch {batch.id} with {len(batch_requests)} requests")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        logger.debug(f"Batch status: {batch.status}")
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise Exception(f"OpenAI batch {batch.id} finished with status: {batch.status}")
+
+    results = {}
+    for line in client.files.content(batch.output_file_id).content.splitlines():
+        result = orjson.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            logger.warning(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+            continue
+        results[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+
+def translate_srt_batch(srt_files: list, from_lang: str, to_lang: str, urgent: bool = False) -> list:
+    """
+    Translate several SRT files through the OpenAI Batch API
+
+    Batch jobs cost half as much and have their own rate limits, but can take
+    up to 24 hours. Use urgent=True to translate with regular requests instead.
+
+    Args:
+        srt_files (list): Paths to SRT files to translate
+        from_lang (str): Source language code
+        to_lang (str): Target language code
+        urgent (bool): Skip the Batch API and translate right away
+
+    Returns:
+        list: Paths to the translated SRT files, in the same order
+    """
+    if urgent:
+        return [translate_srt(srt_file, from_lang, to_lang) for srt_file in srt_files]
+
+    jobs = []
+    batch_requests = {}
+    for file_num, srt_file in enumerate(srt_files):
+        cues = parse_srt_cues(iter_cues(srt_file))
+        translations, misses = lookup_cached(cues, from_lang, to_lang)
+        jobs.append((srt_file, cues, translations, misses))
+        for start, end in chunk_ranges(misses):
+            batch_requests[f"file{file_num}#chunk{start}"] = {
+                "model": OPENAI_MODEL,
+                "messages": build_messages(misses[start:end], from_lang, to_lang)
+            }
+
+    results = run_batch(batch_requests) if batch_requests else {}
+
+    output_paths = []
+    for file_num, (srt_file, cues, translations, misses) in enumerate(jobs):
+        translated = {}
+        for start, end in chunk_ranges(misses):
+            custom_id = f"file{file_num}#chunk{start}"
+            if custom_id not in results:
+                continue
+            # Same numbering check as translate_texts; a misnumbered chunk keeps its original text
+            segments = parse_chunk_reply(results[custom_id], end - start)
+            if segments is None:
+                logger.error(f"Batch reply for {custom_id} was misnumbered, keeping original text")
+                continue
+            translated.update({start + i: text for i, text in segments.items()})
+        store_translations(translations, misses, translated, from_lang, to_lang)
+
+        new_filepath = translated_srt_path(srt_file, from_lang, to_lang)
+        logger.info(f"Saving translated file to {new_filepath}")
+        with open(new_filepath, 'w', encoding='utf-8') as f:
+            f.write(build_srt(cues, translations))
+        output_paths.append(new_filepath)
+
+    return output_paths
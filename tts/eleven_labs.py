@@ -6,7 +6,7 @@ Each speaker's lines are converted using a different voice.
 
 Prerequisites:
     - ElevenLabs API key set as ELEVENLABS_API_KEY environment variable
-    - Required packages: elevenlabs, pydub
+    - Required packages: elevenlabs, httpx[http2], pydub, diskcache
 
 Usage:
     python eleven_labs.py --input INPUT_SRT --voices "Voice1" "Voice2" "Voice3" [--output OUTPUT_PATH]
@@ -21,11 +21,19 @@ Example:
 """
 
 import argparse
+import asyncio
+import hashlib
+import httpx
+import io
+import itertools
 import os
 import logging
 import pydub
+import random
 import re
-from elevenlabs.client import ElevenLabs
+from diskcache import Cache
+from elevenlabs.client import AsyncElevenLabs, is_voice_id
+from elevenlabs.core.api_error import ApiError
 
 # Configure logging
 logging.basicConfig(
@@ -37,67 +45,175 @@ logger = logging.getLogger(__name__)
 
 elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
 
+# Speaker label at the start of a cue's text; compiled once and matched per cue
+SPEAKER_RE = re.compile(r'^Speaker (\d+):\s*(.*)\Z', re.DOTALL)
+
+# Lines synthesized at once; keeps us under the ElevenLabs concurrent request limit
+TTS_MAX_CONCURRENCY = 4
+
+TTS_MODEL = "eleven_multilingual_v2"
+
+# Rate limited, timed out and failed syntheses are retried with exponential backoff (seconds)
+TTS_MAX_RETRIES = 5
+TTS_RETRY_INITIAL_DELAY = 1
+TTS_RETRY_MAX_DELAY = 30
+
+# Synthesized mp3 per (voice, model, text), so repeated lines are only paid for once; least recently used audio is trimmed past 2 GB
+tts_cache = Cache(
+    os.path.expanduser("~/.cache/remake-pod/tts"),
+    size_limit=2 * 1024 ** 3,
+    eviction_policy="least-recently-used"
+)
+
+
+def parse_cue(cue):
+    """Extract the (speaker, text) line from one SRT cue block, or None if it has no speaker label."""
+    # Skip the index and timing lines; the label starts the cue text
+    match = SPEAKER_RE.match("\n".join(cue.strip().split("\n")[2:]))
+    if not match:
+        return None
+    return int(match.group(1)), match.group(2).strip()
+
+def parse_srt_text(content):
+    """Extract speaker lines from SRT content."""
+    return [line for line in map(parse_cue, re.split(r'\n\s*\n', content.strip())) if line is not None]
 
 def parse_srt(srt_file):
-    """Parse SRT file and extract speaker lines."""
+    """Parse SRT file and extract speaker lines, reading it a cue at a time."""
     speaker_lines = []
+    cue = []
     with open(srt_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-        
-    # Extract speaker lines using regex
-    pattern = r'Speaker (\d+): (.*?)(?=\n\n|\Z)'
-    matches = re.finditer(pattern, content, re.DOTALL)
-    
-    for match in matches:
-        speaker_num = int(match.group(1))
-        text = match.group(2).strip()
-        speaker_lines.append((speaker_num, text))
-        
+        # A blank line (or the end of the file) ends a cue
+        for line in itertools.chain(f, ["\n"]):
+            if line.strip():
+                cue.append(line)
+                continue
+            speaker_line = parse_cue("".join(cue)) if cue else None
+            if speaker_line is not None:
+                speaker_lines.append(speaker_line)
+            cue = []
     return speaker_lines
 
-def generate_speech(input_file, voices, output):
-    """Generate speech from SRT file using ElevenLabs API with multiple voices."""
-    try:
-        # Parse SRT and get speaker lines first
-        speaker_lines = parse_srt(input_file)
-        
-        # Initialize ElevenLabs services for each voice
-        voice_services = []
-        for voice in voices:
-            service = ElevenLabs(api_key=elevenlabs_api_key)
-            voice_services.append(service)
-
-        # Create empty audio mix
-        final_mix = pydub.AudioSegment.empty()
-        
-        # Generate audio for each speaker line
-        for speaker_num, text in speaker_lines:
-            if speaker_num >= len(voices):
-                logger.warning(f"No voice assigned for Speaker {speaker_num}, skipping line")
-                continue
-                
-            logger.info(f"Generating speech for Speaker {speaker_num}: {text[:30]}...")
-            audio = voice_services[speaker_num].generate(text=text, voice=voices[speaker_num], model="eleven_multilingual_v2")
-            
-            # Save audio to temp file
-            with open("temp.mp3", "wb") as f:
-                for chunk in audio:
-                    f.write(chunk)
-            
-            # Add to final mix
-            audio_segment = pydub.AudioSegment.from_mp3("temp.mp3")
-            final_mix += audio_segment
-
-        # Export final audio
-        final_mix.export(output, format="mp3")
-        logger.info(f"Audio saved to {output}")
+def decode_mp3(audio):
+    """Decode mp3 bytes straight from memory."""
+    return pydub.AudioSegment.from_file(io.BytesIO(audio), format="mp3")
+
+def is_retryable(err):
+    """Whether a failed ElevenLabs request is worth retrying."""
+    if isinstance(err, httpx.TransportError):
+        return True
+    return err.status_code is not None and (err.status_code >= 500 or err.status_code in (408, 409, 429))
+
+async def request_speech(client, semaphore, voice, text):
+    """Request the mp3 bytes for one line, retrying transient errors with backoff."""
+    # The SDK doesn't retry streamed responses, so retry here
+    for attempt in range(TTS_MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                audio = await client.generate(text=text, voice=voice, model=TTS_MODEL)
+                return b"".join([chunk async for chunk in audio])
+        except (ApiError, httpx.TransportError) as err:
+            if attempt == TTS_MAX_RETRIES or not is_retryable(err):
+                raise
+            # Sleep outside the semaphore so other lines can use the slot; jitter spreads out the retries
+            delay = min(TTS_RETRY_INITIAL_DELAY * 2 ** attempt, TTS_RETRY_MAX_DELAY) * random.uniform(0.5, 1)
+            logger.warning(f"ElevenLabs request failed ({err}), retrying in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+async def synthesize_line(client, semaphore, voices, speaker_num, text):
+    """Synthesize and decode one speaker line. Returns the audio segment."""
+    key = hashlib.sha256(f"{voices[speaker_num]}|{TTS_MODEL}|{text}".encode("utf-8")).hexdigest()
+    audio = tts_cache.get(key)
+    if audio is None:
+        logger.info(f"Generating speech for Speaker {speaker_num}: {text[:30]}...")
+        audio = await request_speech(client, semaphore, voices[speaker_num], text)
+        tts_cache.set(key, audio)
+
+    # Decode off the event loop (outside the semaphore) so it overlaps the requests still in flight
+    return await asyncio.to_thread(decode_mp3, audio)
+
+async def resolve_voice_ids(client, voices, speaker_nums):
+    """Map the voice names of the given speakers to voice ids with a single lookup, so each line doesn't list all voices again."""
+    names = {voices[speaker_num] for speaker_num in speaker_nums if not is_voice_id(voices[speaker_num])}
+    if not names:
+        return list(voices)
+
+    voices_response = await client.voices.get_all(show_legacy=True, request_options={"max_retries": TTS_MAX_RETRIES})
+    voice_ids = {}
+    for voice in voices_response.voices:
+        voice_ids.setdefault(voice.name, voice.voice_id)
+
+    missing = sorted(names - voice_ids.keys())
+    if missing:
+        raise ValueError(f"Voices not found: {', '.join(missing)}")
+    # Voices of speakers without lines are left as given; nothing is synthesized with them
+    return [voice_ids[voice] if voice in names else voice for voice in voices]
+
+async def synthesize_lines(speaker_lines, voices, max_concurrency=TTS_MAX_CONCURRENCY):
+    """Synthesize speaker lines concurrently, at most max_concurrency at a time. Returns an audio segment per line."""
+    if not speaker_lines:
+        return []
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # One HTTP/2 connection pool for every line, sized to the number of requests in flight
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    async with httpx.AsyncClient(http2=True, timeout=60, follow_redirects=True, limits=limits) as http_client:
+        client = AsyncElevenLabs(api_key=elevenlabs_api_key, httpx_client=http_client)
+        voices = await resolve_voice_ids(client, voices, {speaker_num for speaker_num, _ in speaker_lines})
+        # Repeated lines in this run are synthesized once
+        unique_lines = list(dict.fromkeys(speaker_lines))
+        segments = await asyncio.gather(*(synthesize_line(client, semaphore, voices, speaker_num, text) for speaker_num, text in unique_lines))
+        line_segments = dict(zip(unique_lines, segments))
+        return [line_segments[line] for line in speaker_lines]
+
+def drop_unvoiced_lines(speaker_lines, voices):
+    """Drop lines whose speaker has no voice assigned, warning once per speaker."""
+    unvoiced = sorted({speaker_num for speaker_num, _ in speaker_lines if speaker_num >= len(voices)})
+    if not unvoiced:
+        return speaker_lines
+
+    logger.warning(f"No voice assigned for Speaker(s) {', '.join(map(str, unvoiced))}, skipping their lines")
+    return [(speaker_num, text) for speaker_num, text in speaker_lines if speaker_num < len(voices)]
+
+def concat_segments(segments):
+    """Concatenate audio segments by joining their raw PCM once, instead of copying the mix for every segment."""
+    if not segments:
+        return pydub.AudioSegment.empty()
+
+    # Bring every segment to the first one's format so the raw samples line up
+    first = segments[0]
+    segments = [
+        seg.set_frame_rate(first.frame_rate).set_channels(first.channels).set_sample_width(first.sample_width)
+        for seg in segments
+    ]
+    return pydub.AudioSegment(
+        data=b"".join(seg.raw_data for seg in segments),
+        sample_width=first.sample_width,
+        frame_rate=first.frame_rate,
+        channels=first.channels
+    )
+
+def speak_lines(speaker_lines, voices, output):
+    """Synthesize parsed speaker lines and export them as one mp3."""
+    speaker_lines = drop_unvoiced_lines(speaker_lines, voices)
+    
+    # Generate and decode audio for all speaker lines at once
+    segments = asyncio.run(synthesize_lines(speaker_lines, voices))
 
-    except FileNotFoundError:
-        logger.error(f"Input file not found: {input_file}")
-        exit(1)
-    except Exception as e:
-        logger.error(f"Error generating speech: {e}")
-        exit(1)
+    # Stitch the audio back together in one pass
+    final_mix = concat_segments(segments)
+
+    # Export final audio
+    final_mix.export(output, format="mp3")
+    logger.info(f"Audio saved to {output}")
+
+def generate_speech_from_text(srt_text, voices, output):
+    """Generate speech from in-memory SRT text using ElevenLabs API with multiple voices."""
+    speak_lines(parse_srt_text(srt_text), voices, output)
+
+def generate_speech(input_file, voices, output):
+    """Generate speech from an SRT file using ElevenLabs API with multiple voices."""
+    speak_lines(parse_srt(input_file), voices, output)
 
 def main():
     parser = argparse.ArgumentParser(description='Convert SRT file to speech using ElevenLabs with multiple voices')
@@ -110,7 +226,14 @@ def main():
         logger.error("ELEVENLABS_API_KEY environment variable not set")
         exit(1)
 
-    generate_speech(args.input, args.voices, args.output)
+    try:
+        generate_speech(args.input, args.voices, args.output)
+    except FileNotFoundError:
+        logger.error(f"Input file not found: {args.input}")
+        exit(1)
+    except Exception as e:
+        logger.error(f"Error generating speech: {e}")
+        exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file